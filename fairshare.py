@@ -14,14 +14,38 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import argparse
+import atexit
+import contextlib
 import datetime
-import os.path
+import math
+import re
 import sqlite3
+import sys
 
 
 database = 'fairshare.db'
 
+# The keys of an expense dictionary, in the column order of select_expenses.
+expense_keys = ('id', 'date', 'title', 'payer', 'cost')
+
+# The connection used by the commands, see get_connection.
+shared_connection = None
+
+# Version of the database schema, stored in the user_version pragma.
+# 1: costs are stored as an integer number of cents.
+# 2: debts is keyed by (d_expense, d_debtor) without a rowid.
+schema_version = 2
+
+# Today's date as a YYYYMMDD integer, determined once per run.
+today = int(datetime.date.today().strftime('%Y%m%d'))
+
+# The largest cost of an expense in cents. Far below SQLite's 2**63 limit, so 
+# the sums in get_debts can't overflow either.
+max_cost_cents = 10**13
+
+# Pattern for validating input, compiled once.
+cost_pattern = re.compile(r'\s*[+-]?([0-9]+(\.[0-9]*)?|\.[0-9]+)\s*')
+
 
 class Error(Exception):
     '''Base class for exceptions in this module.'''
@@ -69,74 +93,255 @@ class IllegalExpenseTitleError(IllegalInputError):
     pass
 
 
+class IllegalExpenseDebtorsError(IllegalInputError):
+    '''Exception raised for an invalid list of expense debtors.'''
+    pass
+
+
+class DatabaseUpgradeError(Error):
+    '''Exception raised if a database cannot be upgraded.'''
+    def __init__(self, message):
+        self.message = message
+
+
 def create_database(database):
-    '''Create the SQLite3 database.'''
-    connection = sqlite3.connect(database)
-    cursor = connection.cursor()
-    cursor.execute(
+    '''Create the SQLite3 database, or complete an existing one.
+
+    Tables and indexes missing from an up-to-date database are created too 
+    (create_tables).
+    '''
+    connection = connect(database)
+    create_tables(connection)
+    connection.close()
+
+
+def create_schema(connection):
+    '''Bring the schema of the database up to the current schema_version.
+
+    A new database gets all tables and indexes (create_tables), an existing 
+    one is upgraded first (upgrade_database). A database that already has the 
+    current schema_version is only read, not written.
+
+    Arguments:
+    connection -- the SQLite3 connection to use
+
+    Raises:
+    DatabaseUpgradeError -- if the database has a newer schema_version
+    DatabaseUpgradeError -- if the database cannot be upgraded
+    '''
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version > schema_version:
+        raise DatabaseUpgradeError('the database was created by a newer '
+                                   'version of this program')
+    tables = connection.execute("SELECT name FROM sqlite_master "
+                                "WHERE type='table'").fetchall()
+    if tables and version == schema_version:
+        return
+    if tables:
+        upgrade_database(connection)
+    create_tables(connection)
+
+
+def create_tables(connection):
+    '''Create the tables and indexes that don't exist yet.
+
+    Arguments:
+    connection -- the SQLite3 connection to use
+    '''
+    connection.executescript(
         '''
-        CREATE TABLE users (
+        BEGIN;
+        CREATE TABLE IF NOT EXISTS users (
             "u_id" INTEGER PRIMARY KEY AUTOINCREMENT,
             "u_name" TEXT NOT NULL UNIQUE
-        )
-        '''
-    )
-    cursor.execute(
-        '''
-        CREATE TABLE expenses (
+        );
+        CREATE TABLE IF NOT EXISTS expenses (
             "e_id" INTEGER PRIMARY KEY AUTOINCREMENT,
-            "e_cost" REAL NOT NULL,
+            "e_cost" INTEGER NOT NULL,
             "e_title" TEXT,
             "e_date" TEXT,
             "e_payer" INTEGER NOT NULL,
             FOREIGN KEY(e_payer) REFERENCES users(u_id)
-        )
-        '''
-    )
-    cursor.execute(
-        '''
-        CREATE TABLE debts (
+        );
+        CREATE TABLE IF NOT EXISTS debts (
             "d_expense" INTEGER NOT NULL,
             "d_debtor" INTEGER NOT NULL,
+            PRIMARY KEY(d_expense, d_debtor),
             FOREIGN KEY(d_expense) REFERENCES expenses(e_id),
             FOREIGN KEY(d_debtor) REFERENCES users(u_id)
-        )
-        '''
-    )
-    cursor.execute(
-        '''
-        CREATE TABLE settles (
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS settles (
             "s_id" INTEGER PRIMARY KEY AUTOINCREMENT,
             "s_date" TEXT NOT NULL
-        )
-        '''
-    )
-    cursor.execute(
-        '''
-        CREATE TABLE expenses_settled (
+        );
+        CREATE TABLE IF NOT EXISTS expenses_settled (
             "e_id" INTEGER PRIMARY KEY AUTOINCREMENT,
-            "e_cost" REAL NOT NULL,
+            "e_cost" INTEGER NOT NULL,
             "e_title" TEXT,
             "e_date" TEXT,
             "e_payer" INTEGER NOT NULL,
             "e_settle" INTEGER NOT NULL,
             FOREIGN KEY(e_payer) REFERENCES users(u_id),
             FOREIGN KEY(e_settle) REFERENCES settles(s_id)
-        )
-        '''
-    )
-    cursor.execute(
-        '''
-        CREATE TABLE debts_settled (
+        );
+        CREATE TABLE IF NOT EXISTS debts_settled (
             "d_expense" INTEGER NOT NULL,
             "d_debtor" INTEGER NOT NULL,
             FOREIGN KEY(d_expense) REFERENCES expenses_settled(e_id),
             FOREIGN KEY(d_debtor) REFERENCES users(u_id)
-        )
-        '''
+        );
+        CREATE INDEX IF NOT EXISTS idx_expenses_payer
+            ON expenses(e_payer);
+        CREATE INDEX IF NOT EXISTS idx_expenses_date
+            ON expenses(e_date);
+        CREATE INDEX IF NOT EXISTS idx_debts_debtor
+            ON debts(d_debtor);
+        CREATE INDEX IF NOT EXISTS idx_expenses_settled_payer
+            ON expenses_settled(e_payer);
+        CREATE INDEX IF NOT EXISTS idx_debts_settled_expense
+            ON debts_settled(d_expense, d_debtor);
+        CREATE INDEX IF NOT EXISTS idx_debts_settled_debtor
+            ON debts_settled(d_debtor);
+        PRAGMA user_version={};
+        COMMIT;
+        '''.format(schema_version)
     )
+
+
+def connect(database):
+    '''Open a connection to the SQLite3 database and return it.
+
+    Arguments:
+    database -- path to the database file
+    '''
+    connection = sqlite3.connect(database)
+    set_pragmas(connection, database)
+    create_schema(connection)
+    return connection
+
+
+def get_connection():
+    '''Return the shared connection to the database.
+
+    The connection is opened (connect) on first use and closed when the 
+    program exits.
+    '''
+    global shared_connection
+    if shared_connection is None:
+        shared_connection = connect(database)
+        atexit.register(shared_connection.close)
+    return shared_connection
+
+
+def set_pragmas(connection, database):
+    '''Tune a connection for a short-lived CLI process.
+
+    Enable WAL journaling (unless the database is in memory), relaxed 
+    syncing, a larger page cache and in-memory temporary storage.
+
+    Arguments:
+    connection -- the SQLite3 connection to tune
+    database -- path to the database file
+    '''
+    if database != ':memory:':
+        connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA cache_size=-64000')
+    connection.execute('PRAGMA temp_store=MEMORY')
+
+
+def upgrade_database(connection):
+    '''Upgrade a database created by an older version of this program.
+
+    The upgrade runs as one transaction: it is either applied completely or 
+    not at all.
+
+    Arguments:
+    connection -- the SQLite3 connection to use
+
+    Raises:
+    DatabaseUpgradeError -- if an open expense lists a debtor more than once
+    '''
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version >= schema_version:
+        return
+    if not connection.in_transaction:
+        connection.execute('BEGIN')
+    try:
+        upgrade_schema(connection, version)
+    except BaseException:
+        connection.rollback()
+        raise
     connection.commit()
-    connection.close()
+
+
+def upgrade_schema(connection, version):
+    '''Apply the schema changes since version, see upgrade_database.
+
+    Arguments:
+    connection -- the SQLite3 connection to use
+    version -- the schema version of the database
+
+    Raises:
+    DatabaseUpgradeError -- if an open expense lists a debtor more than once
+    '''
+    if version < 1:
+        # Costs used to be stored as a floating point number of units.
+        for table in ('expenses', 'expenses_settled'):
+            connection.execute('UPDATE {} SET e_cost=CAST(ROUND(e_cost * 100) '
+                               'AS INTEGER)'.format(table))
+    if version < 2:
+        # A debtor listed twice used to pay two shares, which the new primary 
+        # key can't store. Leave it to the user to correct these expenses.
+        repeated = connection.execute('SELECT DISTINCT d_expense FROM debts '
+                                      'GROUP BY d_expense, d_debtor '
+                                      'HAVING COUNT(*) > 1 '
+                                      'ORDER BY d_expense').fetchall()
+        if repeated:
+            raise DatabaseUpgradeError(
+                'expenses {} list a debtor more than once; edit them with the '
+                'previous version first'
+                .format(', '.join(str(e_id) for e_id, in repeated)))
+        # The primary key of debts replaces idx_debts_expense.
+        connection.execute('''
+            CREATE TABLE debts_upgrade (
+                "d_expense" INTEGER NOT NULL,
+                "d_debtor" INTEGER NOT NULL,
+                PRIMARY KEY(d_expense, d_debtor),
+                FOREIGN KEY(d_expense) REFERENCES expenses(e_id),
+                FOREIGN KEY(d_debtor) REFERENCES users(u_id)
+            ) WITHOUT ROWID
+            ''')
+        connection.execute('INSERT INTO debts_upgrade '
+                           'SELECT d_expense, d_debtor FROM debts')
+        connection.execute('DROP TABLE debts')
+        connection.execute('ALTER TABLE debts_upgrade RENAME TO debts')
+        connection.execute('CREATE INDEX idx_debts_debtor ON debts(d_debtor)')
+    connection.execute('PRAGMA user_version={}'.format(schema_version))
+
+
+@contextlib.contextmanager
+def transaction(cursor):
+    '''Run the statements of a with block as one unit.
+
+    The statements are wrapped in a savepoint inside the connection's 
+    transaction. If the block raises an exception all of its changes are 
+    rolled back. Committing is left to the caller, so transactions can be 
+    nested.
+
+    Arguments:
+    cursor -- the SQLite3 cursor to use
+    '''
+    if not cursor.connection.in_transaction:
+        cursor.execute('BEGIN')
+    cursor.execute('SAVEPOINT fairshare')
+    try:
+        yield
+    except BaseException:
+        cursor.execute('ROLLBACK TO fairshare')
+        cursor.execute('RELEASE fairshare')
+        raise
+    cursor.execute('RELEASE fairshare')
 
 
 def get_users_dict(cursor):
@@ -212,17 +417,10 @@ def get_expense(cursor, e_id, u_name=False):
     Raises:
     ExpenseNotFoundError -- if e_id doens't exist
     '''
-    cursor.execute('SELECT e_title, e_cost, e_date, e_payer FROM expenses '
-                   'WHERE e_id=?', (e_id,))
-    result = cursor.fetchone()
-    try:
-        expense = {'id': e_id, 'date': result[2], 'title': result[0], 
-                   'payer': result[3], 'cost': result[1]}
-    except TypeError:
+    row = select_expenses(cursor, u_name, 'WHERE e.e_id=?', (e_id,)).fetchone()
+    if row is None:
         raise ExpenseNotFoundError()
-    if u_name:
-        expense['payer'] = get_u_name(cursor, expense['payer'])
-    return expense
+    return dict(zip(expense_keys, row))
 
 
 def get_expenses(cursor, u_name=False):
@@ -237,22 +435,35 @@ def get_expenses(cursor, u_name=False):
     Keyword arguments:
     u_name -- if True the value for payer is a 'u_name' instead of a 'u_id' 
     '''
-    cursor.execute('SELECT e_id, e_date, e_title, e_payer, e_cost '
-                   'FROM expenses ORDER BY e_date')
-    expenses = list()
-    for x in cursor:
-        expense = {'id': x[0], 'date': x[1], 'title': x[2], 'payer': x[3], 
-                   'cost': x[4]}
-        expenses.append(expense)
+    return [dict(zip(expense_keys, row))
+            for row in select_expenses(cursor, u_name).fetchall()]
+
+
+def select_expenses(cursor, u_name=False, where='', parameters=()):
+    '''Select expenses ordered by date and return the cursor.
+
+    The columns of each row are in the order of expense_keys.
+
+    Arguments:
+    cursor -- the SQLite3 cursor to use
+
+    Keyword arguments:
+    u_name -- if True the value for payer is a 'u_name' instead of a 'u_id' 
+    where -- a WHERE clause on the expenses table 'e'
+    parameters -- the parameters for the WHERE clause
+    '''
     if u_name:
-        users = get_users_dict(cursor)
-        for expense in expenses:
-            expense['payer'] = users[expense['payer']]
-    return expenses
+        payer, join = 'u.u_name', 'JOIN users u ON u.u_id=e.e_payer'
+    else:
+        payer, join = 'e.e_payer', ''
+    cursor.execute('SELECT e.e_id, e.e_date, e.e_title, {}, e.e_cost / 100.0 '
+                   'FROM expenses e {} {} ORDER BY e.e_date, e.e_id'
+                   .format(payer, join, where), parameters)
+    return cursor
 
 
 def get_debtors(cursor, e_id, u_name=False):
-    '''Return a list of debtors for a given e_id.
+    '''Return a list of debtors for a given e_id, ordered by u_id.
 
     Arguments:
     cursor -- the SQLite3 cursor to use
@@ -260,13 +471,16 @@ def get_debtors(cursor, e_id, u_name=False):
 
     Keyword arguments:
     u_name -- if True the value for debtor is a 'u_name' instead of a 'u_id' 
+              and the debtors are ordered by u_name
     '''
-    cursor.execute('SELECT d_debtor FROM debts WHERE d_expense=?', (e_id,))
-    debtors = [debtor[0] for debtor in cursor]
     if u_name:
-        users = get_users_dict(cursor)
-        debtors = [users[debtor] for debtor in debtors]
-    return debtors
+        cursor.execute('SELECT u.u_name FROM debts d '
+                       'JOIN users u ON u.u_id=d.d_debtor '
+                       'WHERE d.d_expense=? ORDER BY u.u_name', (e_id,))
+    else:
+        cursor.execute('SELECT d_debtor FROM debts WHERE d_expense=? '
+                       'ORDER BY d_debtor', (e_id,))
+    return [debtor[0] for debtor in cursor]
 
 
 def get_status_list(cursor):
@@ -280,14 +494,10 @@ def get_status_list(cursor):
     Return format:
     [(this user must pay, this user, this amount), ...]
     '''
-    status = list()
     users = get_users_dict(cursor)
-    cashers = get_status_dict(cursor, users)
-    for casher in users.values():
-        for payer in users.values():
-            if cashers[casher][payer] != 0:
-                status.append((payer, casher, cashers[casher][payer]))
-    return status
+    debts = get_debts(cursor)
+    return [(users[payer], users[casher], debts[(payer, casher)] / 100)
+            for payer, casher in sorted(debts, key=lambda x: (x[1], x[0]))]
 
 
 def get_status_dict(cursor, users):
@@ -311,28 +521,55 @@ def get_status_dict(cursor, users):
      ...
      }
     '''
-    cashers = dict()
-    for casher_u_name in users.values():
-        payers = dict()
-        for payer_u_name in users.values():
-            payers[payer_u_name] = 0
-        cashers[casher_u_name] = payers
-    for expense in get_expenses(cursor, u_name=True):
-        debtors = get_debtors(cursor, expense['id'], u_name=True)
-        share = expense['cost'] / len(debtors)
-        for debtor in debtors:
-            cashers[expense['payer']][debtor] += share
-    for casher in users.values():
-        for payer in users.values():
-            c = abs(cashers[casher][payer] - cashers[payer][casher])
-            if cashers[casher][payer] > cashers[payer][casher]:
-                cashers[casher][payer] = c
-                cashers[payer][casher] = 0
-            elif cashers[casher][payer] == cashers[payer][casher]:
-                cashers[casher][payer] = cashers[payer][casher] = 0
+    cashers = {casher: {payer: 0 for payer in users.values()}
+               for casher in users.values()}
+    for (payer, casher), amount in get_debts(cursor).items():
+        cashers[users[casher]][users[payer]] = amount / 100
     return cashers
 
 
+def get_debts(cursor):
+    '''Return the current net debts between users as a dictionary.
+
+    Pairs of users that don't owe each other anything are left out.
+
+    Arguments:
+    cursor -- the SQLite3 cursor to use
+
+    Return format:
+    {(u_id of the payer, u_id of the casher): amount in cents, ...}
+    '''
+    # The cents that can't be split evenly are paid by the first debtors of 
+    # the expense, so every share adds up exactly. Costs are cast because 
+    # upgraded databases may still store them as REAL.
+    cursor.execute(
+        '''
+        WITH cnt AS (
+            SELECT d_expense, COUNT(*) AS c FROM debts GROUP BY d_expense
+        ),
+        shares AS (
+            SELECT e.e_payer AS casher, d.d_debtor AS debtor,
+                CAST(e.e_cost AS INTEGER) / cnt.c
+                + (ROW_NUMBER() OVER (PARTITION BY e.e_id ORDER BY d.d_debtor)
+                   <= CAST(e.e_cost AS INTEGER) % cnt.c) AS share
+            FROM expenses e
+            JOIN debts d ON d.d_expense=e.e_id
+            JOIN cnt ON cnt.d_expense=e.e_id
+        )
+        SELECT casher, debtor, SUM(share) FROM shares
+        WHERE casher != debtor
+        GROUP BY casher, debtor
+        '''
+    )
+    owed = {(debtor, casher): amount for casher, debtor, amount in cursor}
+    debts = dict()
+    for (payer, casher), amount in owed.items():
+        net = amount - owed.get((casher, payer), 0)
+        if net > 0:
+            debts[(payer, casher)] = net
+    return debts
+
+
 def validate_username(u_name):
     '''Validate a username and return it.
     
@@ -358,36 +595,33 @@ def validate_username(u_name):
     return u_name
 
 
-def validate_user_id(cursor, u_id):
-    '''Check if u_id exists in the database and return it.
-
-    Arguments:
-    cursor -- the SQLite3 cursor to use
-    u_id -- the u_id to check
-    
-    Raises:
-    UserNotFoundError -- if no u_name can be found for the given u_id
-    '''
-    get_u_name(cursor, u_id)
-    return u_id
+def validate_user_ids(cursor, u_ids):
+    '''Check if all u_ids exist in the database and return them (list).
 
-
-def validate_expense_id(cursor, e_id):
-    '''Check if e_id exists in the database and return it.
+    The u_ids are returned as they are stored in the database, so '1' is 
+    returned as 1.
 
     Arguments:
     cursor -- the SQLite3 cursor to use
-    e_id -- the e_id to check
-    
+    u_ids -- the u_ids to check
+
     Raises:
-    ExpenseNotFoundError -- if e_id was not found in the database
+    UserNotFoundError -- if any u_id was not found in the database
     '''
-    cursor.execute('SELECT e_id FROM expenses WHERE e_id=?', (e_id,))
-    try:
-        cursor.fetchone()[0]
-    except TypeError:
-        raise ExpenseNotFoundError()        
-    return e_id
+    u_ids = list(u_ids)
+    # The payer is often one of the debtors too; bind each u_id only once.
+    unique = tuple(set(u_ids))
+    if not unique:
+        return u_ids
+    # SQLite compares the ids like u_id=? would, so 1 and '1' are the same.
+    values = ','.join(['(?)'] * len(unique))
+    cursor.execute('SELECT v.column1, u.u_id FROM (VALUES {}) v '
+                   'LEFT JOIN users u ON u.u_id=v.column1'
+                   .format(values), unique)
+    found = dict(cursor.fetchall())
+    if None in found.values():
+        raise UserNotFoundError()
+    return [found[u_id] for u_id in u_ids]
 
 
 def validate_expense_cost(cost):
@@ -397,18 +631,37 @@ def validate_expense_cost(cost):
     cost -- the cost to validate
     
     Raises:
-    IllegalExpenseCostError -- if cost can not be casted to float
-    IllegalExpenseCostError -- if cost is not greater than 0
+    IllegalExpenseCostError -- if cost is not a finite decimal number
+    IllegalExpenseCostError -- if cost is less than a cent
+    IllegalExpenseCostError -- if cost is more than max_cost_cents cents
     '''
     try:
+        # Numbers skip the pattern, strings must be plain decimals.
+        if not isinstance(cost, (int, float)):
+            if not cost_pattern.fullmatch(cost):
+                raise ValueError()
         cost = float(cost)
-        if not cost > 0:
-            raise IllegalExpenseCostError('cost must be a positive number')
     except (TypeError, ValueError):
         raise IllegalExpenseCostError('cost must be a number')
+    if not math.isfinite(cost):
+        raise IllegalExpenseCostError('cost must be a number')
+    if not cents(cost) > 0:
+        raise IllegalExpenseCostError('cost must be a positive number')
+    if cents(cost) > max_cost_cents:
+        raise IllegalExpenseCostError('cost must be at most {}'
+                                      .format(max_cost_cents // 100))
     return cost
 
 
+def cents(cost):
+    '''Return cost (float) as the whole number of cents that is stored.
+
+    Arguments:
+    cost -- the cost to convert
+    '''
+    return round(cost * 100)
+
+
 def validate_expense_date(date):
     '''Validate date and return it (str).
 
@@ -420,14 +673,32 @@ def validate_expense_date(date):
     IllegalExpenseDateError -- if date is not in YYYYMMDD format
     '''
     try:
-        date_ = datetime.datetime.strptime(date, '%Y%m%d').date()
-        if date_ > datetime.date.today():
-            raise IllegalExpenseDateError('date must be today or before')
+        if not (len(date) == 8 and date.isascii() and date.isdigit()):
+            raise ValueError()
+        # Raises ValueError for days that don't exist.
+        datetime.date(int(date[:4]), int(date[4:6]), int(date[6:]))
     except (TypeError, ValueError):
         raise IllegalExpenseDateError("date format should be 'YYYYMMDD'")
+    if int(date) > today:
+        raise IllegalExpenseDateError('date must be today or before')
     return date
 
 
+def validate_expense_debtors(debtors):
+    '''Validate debtors and return them (list).
+
+    Arguments:
+    debtors -- the u_id's of the debtors to validate
+
+    Raises:
+    IllegalExpenseDebtorsError -- if a debtor is listed more than once
+    '''
+    debtors = list(debtors)
+    if len(set(debtors)) != len(debtors):
+        raise IllegalExpenseDebtorsError('a debtor can only be listed once')
+    return debtors
+
+
 def validate_expense_title(title):
     '''Validate title and return it.
 
@@ -462,6 +733,20 @@ def insert_user(cursor, u_name):
     cursor.execute('INSERT INTO users (u_name) VALUES (?)', (u_name,))
 
 
+def insert_debts(cursor, e_id, debtors):
+    '''Insert the debts of an expense into the database in one batch.
+
+    The arguments are not validated.
+
+    Arguments:
+    cursor -- the SQLite3 cursor to use
+    e_id -- the e_id of the expense
+    debtors -- list of u_id's of the debtors
+    '''
+    cursor.executemany('INSERT INTO debts (d_expense, d_debtor) VALUES (?, ?)',
+                       [(e_id, debtor) for debtor in debtors])
+
+
 def insert_expense(cursor, title, cost, date, payer, debtors):
     '''Insert a new expense into the database.
 
@@ -479,19 +764,63 @@ def insert_expense(cursor, title, cost, date, payer, debtors):
     IllegalExpenseTitleError -- if title is not valid
     IllegalExpenseCostError -- if cost is not valid
     IllegalExpenseDateError -- if date is not valid
+    IllegalExpenseDebtorsError -- if a debtor is listed more than once
     UserNotFoundError -- if payer or one of debtors doesn't exist
     '''
     title = validate_expense_title(title)
     cost = validate_expense_cost(cost)
     date = validate_expense_date(date)
-    payer = validate_user_id(cursor, payer)
-    debtors = [validate_user_id(cursor, debtor) for debtor in debtors]
-    cursor.execute('INSERT INTO expenses (e_cost, e_title, e_date, e_payer) '
-                   'VALUES (?, ?, ?, ?)', (cost, title, date, payer))
-    rowid = cursor.lastrowid
-    for debtor in debtors:
-        cursor.execute('INSERT INTO debts (d_expense, d_debtor) VALUES (?, ?)',
-                       (rowid, debtor))
+    payer, *debtors = validate_user_ids(cursor, [payer] + list(debtors))
+    debtors = validate_expense_debtors(debtors)
+    with transaction(cursor):
+        cursor.execute('INSERT INTO expenses (e_cost, e_title, e_date, '
+                       'e_payer) VALUES (?, ?, ?, ?)',
+                       (cents(cost), title, date, payer))
+        insert_debts(cursor, cursor.lastrowid, debtors)
+
+
+def insert_expenses(cursor, expenses):
+    '''Insert several new expenses into the database in one batch.
+
+    All expenses are validated before any query is executed, so either all 
+    or none of them are inserted.
+
+    Arguments:
+    cursor -- the SQLite3 cursor to use
+    expenses -- list of (title, cost, date, payer, debtors) tuples, with the 
+                arguments of insert_expense
+
+    Raises:
+    IllegalExpenseTitleError -- if a title is not valid
+    IllegalExpenseCostError -- if a cost is not valid
+    IllegalExpenseDateError -- if a date is not valid
+    IllegalExpenseDebtorsError -- if an expense lists a debtor twice
+    UserNotFoundError -- if a payer or one of the debtors doesn't exist
+    '''
+    rows = [(validate_expense_title(title), validate_expense_cost(cost),
+             validate_expense_date(date), payer, list(debtors))
+            for title, cost, date, payer, debtors in expenses]
+    if not rows:
+        return
+    # Validate the users of all expenses at once, then split them up again.
+    u_ids = iter(validate_user_ids(cursor, [u_id for *_, payer, debtors in rows
+                                            for u_id in [payer] + debtors]))
+    rows = [(title, cost, date, next(u_ids),
+             validate_expense_debtors([next(u_ids) for _ in debtors]))
+            for title, cost, date, payer, debtors in rows]
+    with transaction(cursor):
+        cursor.executemany('INSERT INTO expenses (e_cost, e_title, e_date, '
+                           'e_payer) VALUES (?, ?, ?, ?)',
+                           [(cents(cost), title, date, payer)
+                            for title, cost, date, payer, _ in rows])
+        # AUTOINCREMENT hands out consecutive ids within the transaction.
+        cursor.execute('SELECT MAX(e_id) FROM expenses')
+        first = cursor.fetchone()[0] - len(rows) + 1
+        cursor.executemany('INSERT INTO debts (d_expense, d_debtor) '
+                           'VALUES (?, ?)',
+                           [(e_id, debtor)
+                            for e_id, (*_, debtors) in enumerate(rows, first)
+                            for debtor in debtors])
 
 
 def update_user(cursor, old_u_name, new_u_name):
@@ -517,7 +846,8 @@ def update_user(cursor, old_u_name, new_u_name):
 def update_expense(cursor, e_id, title, cost, date, payer, debtors):
     '''Update an expense in the database.
 
-    All arguments are validated before any query is executed.
+    All arguments except e_id are validated before the expense is updated. 
+    The update itself reveals whether e_id exists.
 
     Arguments:
     cursor -- the SQLite3 cursor to use
@@ -532,20 +862,22 @@ def update_expense(cursor, e_id, title, cost, date, payer, debtors):
     ExpenseNotFoundError -- if e_id doesn't exist
     IllegalExpenseCostError -- if cost is not valid
     IllegalExpenseDateError -- if date is not valid
+    IllegalExpenseDebtorsError -- if a debtor is listed more than once
     UserNotFoundError -- if payer or one of debtors doesn't exist
     '''
-    e_id = validate_expense_id(cursor, e_id)
     title = validate_expense_title(title)
     cost = validate_expense_cost(cost)
     date = validate_expense_date(date)
-    payer = validate_user_id(cursor, payer)
-    debtors = [validate_user_id(cursor, debtor) for debtor in debtors]
-    cursor.execute('UPDATE expenses SET e_title=?, e_cost=?, e_date=?, '
-                   'e_payer=? WHERE e_id=?', (title, cost, date, payer, e_id))
-    cursor.execute('DELETE FROM debts WHERE d_expense=?', (e_id,))
-    for debtor in debtors:
-        cursor.execute('INSERT INTO debts (d_expense, d_debtor) VALUES (?, ?)',
-                       (e_id, debtor))
+    payer, *debtors = validate_user_ids(cursor, [payer] + list(debtors))
+    debtors = validate_expense_debtors(debtors)
+    with transaction(cursor):
+        cursor.execute('UPDATE expenses SET e_title=?, e_cost=?, e_date=?, '
+                       'e_payer=? WHERE e_id=?',
+                       (title, cents(cost), date, payer, e_id))
+        if cursor.rowcount == 0:
+            raise ExpenseNotFoundError()
+        cursor.execute('DELETE FROM debts WHERE d_expense=?', (e_id,))
+        insert_debts(cursor, e_id, debtors)
 
 
 def settle_expenses(cursor):
@@ -557,47 +889,57 @@ def settle_expenses(cursor):
     now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     cursor.execute('INSERT INTO settles (s_date) VALUES (?)', (now,))
     s_id = cursor.lastrowid
-    cursor.execute('SELECT e_id, e_cost, e_title, e_date, e_payer '
-                   'FROM expenses')
-    for e_id, e_cost, e_title, e_date, e_payer in [row for row in cursor]:
-        cursor.execute(
-            '''
-            INSERT INTO expenses_settled
-                (e_cost, e_title, e_date, e_payer, e_settle)
-            VALUES
-                (?, ?, ?, ?, ?)
-            ''',
-            (e_cost, e_title, e_date, e_payer, s_id)
-        )
-        new_e_id = cursor.lastrowid
-        cursor.execute('SELECT d_debtor FROM debts WHERE d_expense=?', 
-                       (e_id,))
-        for d_debtor in [row for row in cursor]:
-            cursor.execute(
-                'INSERT INTO debts_settled (d_expense, d_debtor) '
-                'VALUES (?, ?)',
-                (new_e_id, d_debtor[0])
-            )
-        cursor.execute('DELETE FROM expenses WHERE e_id=?', (e_id,))
-        cursor.execute('DELETE FROM debts WHERE d_expense=?', (e_id,))
+    # Keep the e_id so the settled debts can refer to it unchanged.
+    cursor.execute(
+        '''
+        INSERT INTO expenses_settled
+            (e_id, e_cost, e_title, e_date, e_payer, e_settle)
+        SELECT e_id, e_cost, e_title, e_date, e_payer, ?
+        FROM expenses
+        ''',
+        (s_id,)
+    )
+    cursor.execute('INSERT INTO debts_settled (d_expense, d_debtor) '
+                   'SELECT d_expense, d_debtor FROM debts')
+    cursor.execute('DELETE FROM debts')
+    cursor.execute('DELETE FROM expenses')
 
 
-def add_users(args):
-    connection = sqlite3.connect(database)
+def add_users(args, connection):
     cursor = connection.cursor()
-    for name in args.usernames:
+    names = [name.strip() for name in args.usernames]
+    placeholders = ','.join('?' * len(names))
+    cursor.execute('SELECT u_name FROM users WHERE u_name IN ({})'
+                   .format(placeholders), names)
+    existing = {row[0] for row in cursor}
+    new_names = list()
+    for name in names:
         try:
-            insert_user(cursor, name.strip())
+            validate_username(name)
         except IllegalUsernameError as e:
             print("Error: illegal username '{}': {}".format(name, e.message))
-        except sqlite3.IntegrityError:
+            continue
+        if name in existing:
             print('Error: user already exists:', name)
+            continue
+        existing.add(name)
+        new_names.append((name,))
+    try:
+        with transaction(cursor):
+            cursor.executemany('INSERT INTO users (u_name) VALUES (?)',
+                               new_names)
+    except sqlite3.IntegrityError:
+        # Another process added one of the names since the check above.
+        for name, in new_names:
+            try:
+                cursor.execute('INSERT INTO users (u_name) VALUES (?)',
+                               (name,))
+            except sqlite3.IntegrityError:
+                print('Error: user already exists:', name)
     connection.commit()
-    connection.close()
 
 
-def edit_user(args):
-    connection = sqlite3.connect(database)
+def edit_user(args, connection):
     cursor = connection.cursor()
     old, new = args.username[0], args.new_username[0]
     try:
@@ -609,15 +951,12 @@ def edit_user(args):
     except sqlite3.IntegrityError:
         print('Error: user already exists:', new)
     connection.commit()
-    connection.close()
 
 
-def list_users():
-    connection = sqlite3.connect(database)
+def list_users(connection):
     cursor = connection.cursor()
     for u_id, u_name in get_users_list(cursor):
         print(u_name)
-    connection.close()
 
 
 def read_username(cursor, prompt):
@@ -632,39 +971,42 @@ def read_username(cursor, prompt):
     cursor -- the SQLite3 cursor for the u_id lookup
     prompt -- the prompt text
     '''
-    user = input(prompt)
-    try:
-        user = get_u_id(cursor, user)
-    except UserNotFoundError:
-        print("Error: user '{}' doesn't exist".format(user))
-        return read_username(cursor, prompt)
-    return user
+    while True:
+        user = input(prompt)
+        try:
+            return get_u_id(cursor, user)
+        except UserNotFoundError:
+            print("Error: user '{}' doesn't exist".format(user))
 
 
 def read_usernames(cursor, prompt):
     '''Read u_name's from stdin and return the corresponding u_id's.
     
     Read a comma-separated list of values (usernames) from stdin. Each value 
-    must be an existing u_name in the database. Print an error message for each
-    value that doesn't. Repeat until all values are existing u_name's. Return a
-    list of u_id's where each u_id corresponds to a u_name read from stdin.
+    must be an existing u_name in the database and may occur only once. Print 
+    an error message for each value that doesn't. Repeat until all values are 
+    distinct existing u_name's. Return a list of u_id's where each u_id 
+    corresponds to a u_name read from stdin.
 
     Arguments:
     cursor -- the SQLite3 cursor for the u_id lookups
     prompt -- the prompt text
     '''
-    users = list()
-    valid = False
-    while not valid:
-        errors = 0
-        for user in [u.strip() for u in input(prompt).split(',')]:
-            try:
-                users.append(get_u_id(cursor, user))
-            except UserNotFoundError:
-                errors += 1
-                print("Error: User '{}' doesn't exist.".format(user))
-        valid = errors == 0
-    return users
+    while True:
+        names = [u.strip() for u in input(prompt).split(',')]
+        placeholders = ','.join('?' * len(names))
+        cursor.execute('SELECT u_id, u_name FROM users WHERE u_name IN ({})'
+                       .format(placeholders), names)
+        users = {u_name: u_id for u_id, u_name in cursor}
+        missing = [name for name in names if name not in users]
+        repeated = [name for name in dict.fromkeys(names)
+                    if names.count(name) > 1]
+        if not missing and not repeated:
+            return [users[name] for name in names]
+        for name in missing:
+            print("Error: User '{}' doesn't exist.".format(name))
+        for name in repeated:
+            print("Error: User '{}' is listed more than once.".format(name))
 
 
 def read_expense_cost(prompt):
@@ -676,12 +1018,11 @@ def read_expense_cost(prompt):
     Arguments:
     prompt -- the prompt text
     '''
-    try:
-        cost = validate_expense_cost(input(prompt))
-    except IllegalExpenseCostError as e:
-        print('Error: illegal cost: {}'.format(e.message))
-        return read_expense_cost(prompt)
-    return cost
+    while True:
+        try:
+            return validate_expense_cost(input(prompt))
+        except IllegalExpenseCostError as e:
+            print('Error: illegal cost: {}'.format(e.message))
 
 
 def read_expense_date(prompt):
@@ -693,12 +1034,11 @@ def read_expense_date(prompt):
     Arguments:
     prompt -- the prompt text
     '''
-    try:
-        date = validate_expense_date(input(prompt))
-    except IllegalExpenseDateError as e:
-        print('Error: illegal date: {}'.format(e.message))
-        return read_expense_date(prompt)
-    return date
+    while True:
+        try:
+            return validate_expense_date(input(prompt))
+        except IllegalExpenseDateError as e:
+            print('Error: illegal date: {}'.format(e.message))
 
 
 def read_expense_title(prompt):
@@ -710,16 +1050,14 @@ def read_expense_title(prompt):
     Arguments:
     prompt -- the prompt text
     '''
-    try:
-        title = validate_expense_title(input(prompt).strip())
-    except IllegalExpenseTitleError as e:
-        print('Error: illegal title: {}'.format(e.message))
-        return read_expense_title(prompt)
-    return title
+    while True:
+        try:
+            return validate_expense_title(input(prompt).strip())
+        except IllegalExpenseTitleError as e:
+            print('Error: illegal title: {}'.format(e.message))
 
 
-def add_expense():
-    connection = sqlite3.connect(database)
+def add_expense(connection):
     cursor = connection.cursor()
     title = read_expense_title('title: ')
     cost = read_expense_cost('cost: ')
@@ -728,11 +1066,9 @@ def add_expense():
     debtors = read_usernames(cursor, 'debtors: ')
     insert_expense(cursor, title, cost, date, payer, debtors)
     connection.commit()
-    connection.close()
 
 
-def edit_expenses(args):
-    connection = sqlite3.connect(database)
+def edit_expenses(args, connection):
     cursor = connection.cursor()
     for e_id in args.expenses:
         # Retrieve the current expense data.
@@ -752,59 +1088,46 @@ def edit_expenses(args):
         date = read_expense_date('new date: ')
         print('old payer:', expense['payer'])
         payer = read_username(cursor, 'new payer: ')
-        d = ''
-        for debtor in debtors:
-            d += '{}, '.format(debtor)
-        print('old debtors:', d[:-2])
+        print('old debtors:', ', '.join(debtors))
         debtors = read_usernames(cursor, 'new debtors: ')
         # Update the database.
         update_expense(cursor, e_id, title, cost, date, payer, debtors)
         connection.commit()
-    connection.close()
 
 
-def list_expenses():
+def list_expenses(connection):
     headings = {'id': 'ID', 'date': 'Date', 'title': 'Expense', 'payer': 
                 'Payer', 'cost': 'Cost', 'debtors': 'Debtors',}
     header = '{id:3} {date:8} {title:15} {payer:10} {cost:6} {debtors:32}'
     entry = ('{id:3} {date:8} {title:15} {payer:10} {cost:6.2f} {debtors:14} '
              '{share:6.2f} >> {payer:7}')
     print(header.format(**headings))
-    connection = sqlite3.connect(database)
     cursor = connection.cursor()
     for expense in get_expenses(cursor, u_name=True):
         debtors = get_debtors(cursor, expense['id'], u_name=True)
         share = expense['cost'] / len(debtors)
-        debtors_ = ''
-        for debtor in sorted(debtors):
-            if not debtor == expense['payer']:
-                debtors_ += '{}, '.format(debtor)
-        debtors = debtors_[:-2]
+        debtors = ', '.join(d for d in debtors if d != expense['payer'])
         data = {
             'date': expense['date'], 'title': expense['title'], 'payer': 
             expense['payer'], 'cost': expense['cost'], 'debtors': debtors,
             'share': share, 'id': expense['id']
         }
         print(entry.format(**data))
-    connection.close()
 
 
-def list_settled_expenses():
+def list_settled_expenses(connection):
     print('list settled expenses -- not yet implemented')
 
 
-def status():
-    connection = sqlite3.connect(database)
+def status(connection):
     cursor = connection.cursor()
     status = get_status_list(cursor)
     for payer, receiver, amount in status:
         print('{payer} >> {receiver}   {amount:.2f}'
               .format(payer=payer, receiver=receiver, amount=amount))
-    connection.close()
 
 
-def settle():
-    connection = sqlite3.connect(database)
+def settle(connection):
     cursor = connection.cursor()
     status = get_status_list(cursor)
     for payer, receiver, amount in status:
@@ -813,7 +1136,6 @@ def settle():
     if confirm('Settle?', default_y=False):
         settle_expenses(cursor)
         connection.commit()
-    connection.close()
 
 
 def confirm(prompt, default_y=True):
@@ -831,16 +1153,35 @@ def confirm(prompt, default_y=True):
     >>> confirm('Save?')
     Save? [Y/n]: 
     '''
-    ans_y, ans_n = ('y', 'yes'), ('n', 'no')
-    yn = 'Y/n' if default_y else 'y/N'
-    ans = input('{} [{}]: '.format(prompt, yn))
-    while ans.strip().lower() not in ('',) + ans_y + ans_n:
-        ans = input('{} [{}]: '.format(prompt, yn))
-    return ans in (('',) + ans_y if default_y else ans_y)
+    yes = frozenset(('y', 'yes'))
+    valid = yes | frozenset(('', 'n', 'no'))
+    prompt = '{} [{}]: '.format(prompt, 'Y/n' if default_y else 'y/N')
+    ans = input(prompt).strip().lower()
+    while ans not in valid:
+        ans = input(prompt).strip().lower()
+    return ans in yes or (default_y and ans == '')
+
+
+# Commands that take no arguments, keyed by their command line. They run 
+# without importing argparse and building the argument parser.
+direct_commands = {
+    ('add',): add_expense, ('a',): add_expense,
+    ('history',): list_settled_expenses, ('h',): list_settled_expenses,
+    ('list',): list_expenses, ('l',): list_expenses,
+    ('settle',): settle, ('se',): settle,
+    ('status',): status, ('s',): status,
+    ('users', 'list'): list_users, ('users', 'l'): list_users,
+    ('u', 'list'): list_users, ('u', 'l'): list_users,
+}
 
 
 def parse_args():
     '''Parse the CLI arguments and run the program.'''
+    command = direct_commands.get(tuple(sys.argv[1:]))
+    if command is not None:
+        command(get_connection())
+        return
+    import argparse
     parser = argparse.ArgumentParser(
         description='''
         Additional help for every command (the first positional argument) is 
@@ -857,7 +1198,7 @@ def parse_args():
               'aliases': ('a',),
               }
     p_add = subparser.add_parser(*args, **kwargs)
-    p_add.set_defaults(func=add_expense)
+    p_add.set_defaults(func=add_expense, takes_args=False)
 
     ### fs edit expense [expense ...]
     args = ('edit',)
@@ -873,7 +1214,7 @@ def parse_args():
               'type': int,
               }
     p_edit.add_argument(*args, **kwargs)
-    p_edit.set_defaults(func=edit_expenses)
+    p_edit.set_defaults(func=edit_expenses, takes_args=True)
 
     ### fs history
     args = ('history',)
@@ -882,7 +1223,7 @@ def parse_args():
               'aliases': ('h',),
               }
     p_history = subparser.add_parser(*args, **kwargs)
-    p_history.set_defaults(func=list_settled_expenses)
+    p_history.set_defaults(func=list_settled_expenses, takes_args=False)
 
     ### fs list
     args = ('list',)
@@ -891,7 +1232,7 @@ def parse_args():
               'aliases': ('l',),
               }
     p_list = subparser.add_parser(*args, **kwargs)
-    p_list.set_defaults(func=list_expenses)
+    p_list.set_defaults(func=list_expenses, takes_args=False)
 
     ### fs settle
     args = ('settle',)
@@ -900,7 +1241,7 @@ def parse_args():
               'aliases': ('se',),
               }
     p_settle = subparser.add_parser(*args, **kwargs)
-    p_settle.set_defaults(func=settle)
+    p_settle.set_defaults(func=settle, takes_args=False)
 
     ### fs status
     args = ('status',)
@@ -909,7 +1250,7 @@ def parse_args():
               'aliases': ('s',),
               }
     p_status = subparser.add_parser(*args, **kwargs)
-    p_status.set_defaults(func=status)
+    p_status.set_defaults(func=status, takes_args=False)
 
     ### fs users
     args = ('users',)
@@ -933,7 +1274,7 @@ def parse_args():
               'metavar': 'username',
               }
     p_u_add.add_argument(*args, **kwargs)
-    p_u_add.set_defaults(func=add_users)
+    p_u_add.set_defaults(func=add_users, takes_args=True)
 
     ### fs users rename username new_username
     args = ('rename',)
@@ -954,7 +1295,7 @@ def parse_args():
               'metavar': 'new_username',
               }
     p_u_rename.add_argument(*args, **kwargs)
-    p_u_rename.set_defaults(func=edit_user)
+    p_u_rename.set_defaults(func=edit_user, takes_args=True)
 
     ### fs users list
     args = ('list',)
@@ -963,21 +1304,22 @@ def parse_args():
               'aliases': ('l',),
               }
     p_u_list = u_subparser.add_parser(*args, **kwargs)
-    p_u_list.set_defaults(func=list_users)
+    p_u_list.set_defaults(func=list_users, takes_args=False)
 
     ### run command
     args = parser.parse_args()
-    try:
-        args.func(args)
-    except TypeError:
-        # Command takes no argument(s).
-        args.func()
-    except AttributeError as e:
+    if not hasattr(args, 'func'):
         # No command specified.
         parser.print_help()
+        return
+    if args.takes_args:
+        args.func(args, get_connection())
+    else:
+        args.func(get_connection())
 
 
 if __name__ == '__main__':
-    if not os.path.isfile(database):
-        create_database(database)
-    parse_args()
+    try:
+        parse_args()
+    except DatabaseUpgradeError as e:
+        sys.exit('Error: cannot upgrade the database: {}'.format(e.message))
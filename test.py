@@ -15,25 +15,92 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import fairshare as fs
-import os
 import sqlite3
 import unittest
 
 class TestDatabase(unittest.TestCase):
     '''Base class for database related unit tests.
     
-    Provides setUp and tearDown methods that create and destroy a database 
-    for testing purposes.
+    Provides setUp and tearDown methods that create and destroy an in-memory
+    database for testing purposes.
     '''
     def setUp(self):
-        self.db = 'fairsharetest.db'
-        fs.create_database(self.db)
-        self.connection = sqlite3.connect(self.db)
+        self.connection = sqlite3.connect(':memory:')
+        fs.set_pragmas(self.connection, ':memory:')
+        fs.create_schema(self.connection)
         self.cursor = self.connection.cursor()
 
     def tearDown(self):
         self.connection.close()
-        os.remove(self.db)
+
+
+class TestDatabaseSchema(TestDatabase):
+    def make_version_1(self, debts):
+        '''Turn the database into a version 1 database with the given debts.'''
+        self.connection.executescript('''
+            DROP TABLE debts;
+            CREATE TABLE debts (
+                "d_expense" INTEGER NOT NULL,
+                "d_debtor" INTEGER NOT NULL
+            );
+            CREATE INDEX idx_debts_expense ON debts(d_expense, d_debtor);
+            PRAGMA user_version=1;
+            ''')
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        self.cursor.execute('INSERT INTO expenses (e_cost, e_title, e_date, '
+                            "e_payer) VALUES (3000, 'test', '20130101', 1)")
+        self.cursor.executemany('INSERT INTO debts VALUES (1, ?)',
+                                [(debtor,) for debtor in debts])
+        self.connection.commit()
+
+    def test_upgrade_database(self):
+        self.make_version_1((2, 1))
+        fs.create_schema(self.connection)
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        self.assertEqual(version[0], fs.schema_version)
+        self.assertEqual(fs.get_debtors(self.cursor, 1), [1, 2])
+        self.assertEqual(fs.get_debts(self.cursor), {(2, 1): 1500})
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                            "WHERE tbl_name='debts' ORDER BY name")
+        self.assertEqual(self.cursor.fetchall(),
+                         [('debts',), ('idx_debts_debtor',)])
+
+    def test_upgrade_database_with_repeated_debtor(self):
+        '''the upgrade should change nothing if a debtor is listed twice'''
+        self.make_version_1((2, 1, 2))
+        self.assertRaises(fs.DatabaseUpgradeError, fs.create_schema,
+                          self.connection)
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        self.assertEqual(version[0], 1)
+        self.cursor.execute('SELECT d_debtor FROM debts ORDER BY d_debtor')
+        self.assertEqual(self.cursor.fetchall(), [(1,), (2,), (2,)])
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                            "WHERE name='debts_upgrade'")
+        self.assertEqual(self.cursor.fetchall(), [])
+
+    def test_create_schema_on_newer_database(self):
+        '''create_schema should leave a newer database alone'''
+        version = fs.schema_version + 1
+        self.connection.execute('PRAGMA user_version={}'.format(version))
+        self.assertRaises(fs.DatabaseUpgradeError, fs.create_schema,
+                          self.connection)
+        result = self.connection.execute('PRAGMA user_version').fetchone()
+        self.assertEqual(result[0], version)
+
+    def test_create_tables_on_incomplete_database(self):
+        self.connection.execute('DROP INDEX idx_debts_debtor')
+        fs.create_tables(self.connection)
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                            "WHERE name='idx_debts_debtor'")
+        self.assertEqual(self.cursor.fetchall(), [('idx_debts_debtor',)])
+
+    def test_create_schema_on_up_to_date_database(self):
+        '''create_schema should not write to an up-to-date database'''
+        self.connection.execute('PRAGMA query_only=ON')
+        fs.create_schema(self.connection)
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        self.assertEqual(version[0], fs.schema_version)
 
 
 class TestDatabaseUsers(TestDatabase):
@@ -41,7 +108,6 @@ class TestDatabaseUsers(TestDatabase):
         self.assertEqual(fs.get_users_dict(self.cursor), {})
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         users_expected = {1: 'user1', 2: 'user2'}
         self.assertEqual(fs.get_users_dict(self.cursor), users_expected)
 
@@ -49,14 +115,12 @@ class TestDatabaseUsers(TestDatabase):
         self.assertEqual(fs.get_users_list(self.cursor), [])
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         users_expected = [(1, 'user1'), (2, 'user2')]
         self.assertEqual(fs.get_users_list(self.cursor), users_expected)
 
     def test_insert_user(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         users_expected = [(1, 'user1'), (2, 'user2')]
         self.assertEqual(fs.get_users_list(self.cursor), users_expected)
 
@@ -69,7 +133,6 @@ class TestDatabaseUsers(TestDatabase):
     def test_update_user(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         users_expected = [(1, 'user1'), (2, 'user2')]
         self.assertEqual(fs.get_users_list(self.cursor), users_expected)
         fs.update_user(self.cursor, 'user2', 'user3')
@@ -82,7 +145,6 @@ class TestDatabaseUsers(TestDatabase):
 
     def test_get_u_id(self):
         fs.insert_user(self.cursor, 'user1')
-        self.connection.commit()
         self.assertEqual(fs.get_u_id(self.cursor, 'user1'), 1)
 
     def test_get_u_id_for_u_name_that_does_not_exist(self):
@@ -93,25 +155,66 @@ class TestDatabaseUsers(TestDatabase):
 
     def test_get_u_name(self):
         fs.insert_user(self.cursor, 'user1')
-        self.connection.commit()
         self.assertEqual(fs.get_u_name(self.cursor, 1), 'user1')
 
+    def test_get_u_name_after_update_user(self):
+        fs.insert_user(self.cursor, 'user1')
+        self.assertEqual(fs.get_u_name(self.cursor, 1), 'user1')
+        fs.update_user(self.cursor, 'user1', 'user2')
+        self.assertEqual(fs.get_u_name(self.cursor, 1), 'user2')
+        self.assertEqual(fs.get_u_name(self.cursor, '1'), 'user2')
+        self.assertEqual(fs.get_u_id(self.cursor, 'user2'), 1)
+        self.assertRaises(fs.UserNotFoundError, fs.get_u_id,
+                          self.cursor, 'user1')
+
+    def test_get_u_id_after_rollback(self):
+        fs.insert_user(self.cursor, 'user1')
+        self.connection.commit()
+        fs.insert_user(self.cursor, 'user2')
+        self.assertEqual(fs.get_u_id(self.cursor, 'user2'), 2)
+        self.connection.rollback()
+        self.assertRaises(fs.UserNotFoundError, fs.get_u_id,
+                          self.cursor, 'user2')
+
     def test_get_u_name_for_u_id_that_does_not_exist(self):
         values = (1, '', ' ', 'user1')
         for x in values:
             self.assertRaises(fs.UserNotFoundError, fs.get_u_name,
                               self.cursor, x)
 
+    def test_transaction(self):
+        fs.insert_user(self.cursor, 'user1')
+        with fs.transaction(self.cursor):
+            fs.insert_user(self.cursor, 'user2')
+        with self.assertRaises(sqlite3.IntegrityError):
+            with fs.transaction(self.cursor):
+                fs.insert_user(self.cursor, 'user3')
+                fs.insert_user(self.cursor, 'user1')
+        self.connection.commit()
+        users_expected = [(1, 'user1'), (2, 'user2')]
+        self.assertEqual(fs.get_users_list(self.cursor), users_expected)
+
+    def test_validate_user_ids(self):
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        self.assertEqual(fs.validate_user_ids(self.cursor, (1, 2, 1)),
+                         [1, 2, 1])
+        self.assertEqual(fs.validate_user_ids(self.cursor, (1, '1')), [1, 1])
+        values = ((3,), (1, 3), (2, 'a'), ('',), (None,))
+        for x in values:
+            self.assertRaises(fs.UserNotFoundError, fs.validate_user_ids,
+                              self.cursor, x)
+
 
 class TestDatabaseExpenses(TestDatabase):
     def test_get_expense(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
-        fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test2', 30, '20130102', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test3', 40, '20130103', 2, (1, 2))
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test1', 20, '20130101', 1, (1, 2)),
+            ('test2', 30, '20130102', 1, (1, 2)),
+            ('test3', 40, '20130103', 2, (1, 2)),
+        ])
         expected_exp = (
             {'id': 1, 'date': '20130101', 'title': 'test1', 'payer': 1, 
              'cost': 20},
@@ -120,8 +223,17 @@ class TestDatabaseExpenses(TestDatabase):
             {'id': 3, 'date': '20130103', 'title': 'test3', 'payer': 2, 
              'cost': 40},
         )
-        for i in range(len(expected_exp)):
-            self.assertEqual(fs.get_expense(self.cursor, i+1), expected_exp[i])
+        self.assertEqual([fs.get_expense(self.cursor, i+1) for i in range(3)],
+                         list(expected_exp))
+
+    def test_get_expense_with_u_name(self):
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        fs.insert_expense(self.cursor, 'test1', 20, '20130101', 2, (1, 2))
+        expected_exp = {'id': 1, 'date': '20130101', 'title': 'test1', 
+                        'payer': 'user2', 'cost': 20}
+        self.assertEqual(fs.get_expense(self.cursor, 1, u_name=True),
+                         expected_exp)
 
     def test_get_expense_that_does_not_exist(self):
         values = (1, 'a', '')
@@ -133,11 +245,11 @@ class TestDatabaseExpenses(TestDatabase):
         self.assertEqual(fs.get_expenses(self.cursor), [])
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
-        fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test2', 30, '20130102', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test3', 40, '20130103', 2, (1, 2))
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test1', 20, '20130101', 1, (1, 2)),
+            ('test2', 30, '20130102', 1, (1, 2)),
+            ('test3', 40, '20130103', 2, (1, 2)),
+        ])
         expected_result = [
             {'id': 1, 'date': '20130101', 'title': 'test1', 'payer': 1, 
              'cost': 20},
@@ -151,14 +263,23 @@ class TestDatabaseExpenses(TestDatabase):
     def test_get_debtors(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test1', 20, '20130101', 1, (1, 2)),
+            ('test2', 30, '20130102', 1, (1, 2)),
+            ('test3', 40, '20130103', 2, (1, 2)),
+        ])
+        expected_deb = [[1, 2], [1, 2], [1, 2]]
+        self.assertEqual([fs.get_debtors(self.cursor, i+1) for i in range(3)],
+                         expected_deb)
+
+    def test_get_debtors_with_u_name(self):
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test2', 30, '20130102', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test3', 40, '20130103', 2, (1, 2))
-        self.connection.commit()
-        expected_deb = ([1, 2], [1, 2], [1, 2])
-        for i in range(len(expected_deb)):
-            self.assertEqual(fs.get_debtors(self.cursor, i+1), expected_deb[i])
+        fs.update_user(self.cursor, 'user1', 'user3')
+        expected_deb = ['user2', 'user3']
+        self.assertEqual(fs.get_debtors(self.cursor, 1, u_name=True),
+                         expected_deb)
 
     def test_get_debtors_for_expense_that_does_not_exist(self):
         '''get_debtors should return an empty list if e_id doesn't exist'''
@@ -170,22 +291,25 @@ class TestDatabaseExpenses(TestDatabase):
         self.assertEqual(fs.get_status_list(self.cursor), [])
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        fs.insert_expense(self.cursor, 'test', 20, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 30, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 40, '20130101', 2, (1, 2))
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test', 20, '20130101', 1, (1, 2)),
+            ('test', 30, '20130101', 1, (1, 2)),
+            ('test', 40, '20130101', 2, (1, 2)),
+        ])
         expected_status =  [('user2', 'user1', 5)]
         self.assertEqual(fs.get_status_list(self.cursor), expected_status)
-        fs.insert_expense(self.cursor, 'test', 40, '20130101', 2, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 40, '20130101', 2, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 5, '20130101', 1, (1, 2))
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test', 40, '20130101', 2, (1, 2)),
+            ('test', 40, '20130101', 2, (1, 2)),
+            ('test', 5, '20130101', 1, (1, 2)),
+        ])
         expected_status =  [('user1', 'user2', 32.5)]
         self.assertEqual(fs.get_status_list(self.cursor), expected_status)
         fs.insert_user(self.cursor, 'user3')
-        fs.insert_expense(self.cursor, 'test', 105, '20130101', 3, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 210, '20130101', 3, (1, 2, 3))
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test', 105, '20130101', 3, (1, 2)),
+            ('test', 210, '20130101', 3, (1, 2, 3)),
+        ])
         expected_status =  [
             ('user1', 'user2', 32.5),
             ('user1', 'user3', 122.5),
@@ -193,21 +317,35 @@ class TestDatabaseExpenses(TestDatabase):
         ]
         self.assertEqual(fs.get_status_list(self.cursor), expected_status)
 
+    def test_get_status_list_with_uneven_shares(self):
+        '''cents that can't be split evenly go to the first debtors'''
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        fs.insert_user(self.cursor, 'user3')
+        fs.insert_expenses(self.cursor, [
+            ('test', 10, '20130101', 3, (1, 2, 3)),
+            ('test', 0.3, '20130101', 1, (1, 2)),
+        ])
+        expected_status = [('user2', 'user1', 0.15), ('user1', 'user3', 3.34),
+                           ('user2', 'user3', 3.33)]
+        self.assertEqual(fs.get_status_list(self.cursor), expected_status)
+
     def test_get_status_dict(self):
         users = fs.get_users_dict(self.cursor)
         self.assertEqual(fs.get_status_dict(self.cursor, users), {})
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_user(self.cursor, 'user3')
-        fs.insert_expense(self.cursor, 'test', 20, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 30, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 40, '20130101', 2, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 40, '20130101', 2, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 40, '20130101', 2, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 5, '20130101', 1, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 105, '20130101', 3, (1, 2))
-        fs.insert_expense(self.cursor, 'test', 210, '20130101', 3, (1, 2, 3))
-        self.connection.commit()
+        fs.insert_expenses(self.cursor, [
+            ('test', 20, '20130101', 1, (1, 2)),
+            ('test', 30, '20130101', 1, (1, 2)),
+            ('test', 40, '20130101', 2, (1, 2)),
+            ('test', 40, '20130101', 2, (1, 2)),
+            ('test', 40, '20130101', 2, (1, 2)),
+            ('test', 5, '20130101', 1, (1, 2)),
+            ('test', 105, '20130101', 3, (1, 2)),
+            ('test', 210, '20130101', 3, (1, 2, 3)),
+        ])
         expected_status = {
             'user1': {'user1': 0, 'user2': 0, 'user3': 0},
             'user2': {'user1': 32.5, 'user2': 0, 'user3': 0},
@@ -217,14 +355,24 @@ class TestDatabaseExpenses(TestDatabase):
         self.assertEqual(fs.get_status_dict(self.cursor, users), 
                          expected_status)
 
+    def test_get_debts(self):
+        self.assertEqual(fs.get_debts(self.cursor), {})
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        fs.insert_user(self.cursor, 'user3')
+        fs.insert_expenses(self.cursor, [
+            ('test', 20, '20130101', 1, (1, 2)),
+            ('test', 10, '20130101', 2, (1, 2)),
+            ('test', 30, '20130101', 3, (3,)),
+        ])
+        self.assertEqual(fs.get_debts(self.cursor), {(2, 1): 500})
+
     def test_insert_expense(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
         fs.insert_expense(self.cursor, 'test2', 30, '20130102', 1, (1, 2))
         fs.insert_expense(self.cursor, 'test3', 40, '20130103', 2, (1, 2))
-        self.connection.commit()
         expected_exp = (
             {'id': 1, 'date': '20130101', 'title': 'test1', 'payer': 1, 
              'cost': 20},
@@ -233,66 +381,93 @@ class TestDatabaseExpenses(TestDatabase):
             {'id': 3, 'date': '20130103', 'title': 'test3', 'payer': 2, 
              'cost': 40},
         )
-        expected_deb = ([1, 2], [1, 2], [1, 2])
-        for i in range(len(expected_exp)):
-            self.assertEqual(fs.get_expense(self.cursor, i+1), expected_exp[i])
-            self.assertEqual(fs.get_debtors(self.cursor, i+1), expected_deb[i])
+        expected_deb = [[1, 2], [1, 2], [1, 2]]
+        self.assertEqual(fs.get_expenses(self.cursor), list(expected_exp))
+        self.assertEqual([fs.get_debtors(self.cursor, e['id'])
+                          for e in expected_exp], expected_deb)
                          
     def test_insert_expense_with_invalid_title(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         values = (' title ', ' title', '', ' ')
         for x in values:
             self.assertRaises(fs.IllegalExpenseTitleError, fs.insert_expense, 
                               self.cursor, x, 20, '20130101', 1, (1, 2))
-        self.connection.commit()
 
     def test_insert_expense_with_invalid_cost(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         values = (-30, '-30', 0, '0', '', ' ', '-.2')
         for x in values:
             self.assertRaises(fs.IllegalExpenseCostError, fs.insert_expense, 
                               self.cursor, 'test', x, '20130101', 1, (1, 2))
-        self.connection.commit()
 
     def test_insert_expense_with_invalid_date(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         values = ('20130229', 'jfjfjf', '130101', '', ' ')
         for x in values:
             self.assertRaises(fs.IllegalExpenseDateError, fs.insert_expense, 
                               self.cursor, 'test', 20, x, 1, (1, 2))
-        self.connection.commit()
 
     def test_insert_expense_with_unknown_payer(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         values = (3, 4, 9000, 'a', '')
         for x in values:
             self.assertRaises(fs.UserNotFoundError, fs.insert_expense, 
                               self.cursor, 'test', 20, '20130101', x, (1, 2))
-        self.connection.commit()
 
     def test_insert_expense_with_unknown_debtor(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         values = (3, 4, 9000, 'a', '')
         for x in values:
             self.assertRaises(fs.UserNotFoundError, fs.insert_expense, 
                               self.cursor, 'test', 20, '20130101', 1, (1, x))
-        self.connection.commit()
+
+    def test_insert_expenses(self):
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
+        fs.insert_expenses(self.cursor, [
+            ('test2', '30', '20130102', 2, (1,)),
+            ('test3', 40, '20130103', 1, (2,)),
+        ])
+        self.assertEqual([e['title'] for e in fs.get_expenses(self.cursor)],
+                         ['test1', 'test2', 'test3'])
+        self.assertEqual(fs.get_expense(self.cursor, 2)['cost'], 30)
+        self.assertEqual(fs.get_debtors(self.cursor, 2), [1])
+        self.assertEqual(fs.get_debtors(self.cursor, 3), [2])
+
+    def test_insert_expenses_with_invalid_expense(self):
+        '''insert_expenses should insert nothing if any expense is invalid'''
+        fs.insert_user(self.cursor, 'user1')
+        expenses = [('test1', 20, '20130101', 1, (1,)),
+                    ('test2', 20, '20130101', 1, (1, 2))]
+        self.assertRaises(fs.UserNotFoundError, fs.insert_expenses,
+                          self.cursor, expenses)
+        expenses[1] = ('test2', -20, '20130101', 1, (1,))
+        self.assertRaises(fs.IllegalExpenseCostError, fs.insert_expenses,
+                          self.cursor, expenses)
+        expenses[1] = ('test2', 20, '20130101', 1, (1, 1))
+        self.assertRaises(fs.IllegalExpenseDebtorsError, fs.insert_expenses,
+                          self.cursor, expenses)
+        self.assertEqual(fs.get_expenses(self.cursor), [])
+
+    def test_insert_expense_with_repeated_debtor(self):
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        values = ((2, 1, 2), (1, 1), (1, '1'))
+        for x in values:
+            self.assertRaises(fs.IllegalExpenseDebtorsError, fs.insert_expense,
+                              self.cursor, 'test', 20, '20130101', 1, x)
+        self.assertEqual(fs.get_expenses(self.cursor), [])
 
     def test_update_expense(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        self.connection.commit()
         fs.update_expense(self.cursor, 1, 'edit1', 30, '20130102', 2, (1,))
         expected_expense = {'id': 1, 'title': 'edit1', 'cost': 30, 
                             'date': '20130102', 'payer': 2}
@@ -303,7 +478,6 @@ class TestDatabaseExpenses(TestDatabase):
     def test_update_expense_that_does_not_exist(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
-        self.connection.commit()
         values = (1, 2, '', ' ', 'a')
         for x in values:
             self.assertRaises(fs.ExpenseNotFoundError, fs.update_expense, 
@@ -313,60 +487,71 @@ class TestDatabaseExpenses(TestDatabase):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        self.connection.commit()
         values = (' title ', ' title', '', ' ')
         for x in values:
             self.assertRaises(fs.IllegalExpenseTitleError, fs.update_expense, 
                               self.cursor, 1, x, 20, '20130101', 2, (1, 2))
-        self.connection.commit()
 
     def test_update_expense_with_invalid_cost(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        self.connection.commit()
         values = (-30, '-30', 0, '0', '', ' ', '-.2')
         for x in values:
             self.assertRaises(fs.IllegalExpenseCostError, fs.update_expense, 
                               self.cursor, 1, 'edit', x, '20130102', 2, (1, 2))
-        self.connection.commit()
 
     def test_update_expense_with_invalid_date(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        self.connection.commit()
         values = ('20130229', 'jfjfjf', '130101', '', ' ')
         for x in values:
             self.assertRaises(fs.IllegalExpenseDateError, fs.update_expense, 
                               self.cursor, 1, 'edit', 20, x, 2, (1, 2))
-        self.connection.commit()
 
     def test_update_expense_with_unknown_payer(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        self.connection.commit()
         values = (3, 4, 9000, 'a', '')
         for x in values:
             self.assertRaises(fs.UserNotFoundError, fs.update_expense, 
                               self.cursor, 1, 'edit', 20, '20130101', x, (2,))
-        self.connection.commit()
 
     def test_update_expense_with_unknown_debtor(self):
         fs.insert_user(self.cursor, 'user1')
         fs.insert_user(self.cursor, 'user2')
         fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
-        self.connection.commit()
         values = (3, 4, 9000, 'a', '')
         for x in values:
             self.assertRaises(fs.UserNotFoundError, fs.update_expense, 
                               self.cursor, 1, 'edit', 20, '20130101', 1, (x,))
-        self.connection.commit()
+
+    def test_update_expense_with_repeated_debtor(self):
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
+        self.assertRaises(fs.IllegalExpenseDebtorsError, fs.update_expense,
+                          self.cursor, 1, 'edit', 20, '20130101', 1, (2, 2))
+        self.assertEqual(fs.get_debtors(self.cursor, 1), [1, 2])
 
     def test_settle_expenses(self):
-        '''not yet implemented'''
-        pass
+        fs.insert_user(self.cursor, 'user1')
+        fs.insert_user(self.cursor, 'user2')
+        fs.insert_expense(self.cursor, 'test1', 20, '20130101', 1, (1, 2))
+        fs.insert_expense(self.cursor, 'test2', 30, '20130102', 2, (1,))
+        fs.settle_expenses(self.cursor)
+        self.assertEqual(fs.get_expenses(self.cursor), [])
+        self.assertEqual(fs.get_status_list(self.cursor), [])
+        self.cursor.execute('SELECT e_id, e_cost, e_title, e_date, e_payer, '
+                            'e_settle FROM expenses_settled ORDER BY e_id')
+        expected_exp = [(1, 2000, 'test1', '20130101', 1, 1),
+                        (2, 3000, 'test2', '20130102', 2, 1)]
+        self.assertEqual(self.cursor.fetchall(), expected_exp)
+        self.cursor.execute('SELECT d_expense, d_debtor FROM debts_settled '
+                            'ORDER BY d_expense, d_debtor')
+        self.assertEqual(self.cursor.fetchall(), [(1, 1), (1, 2), (2, 1)])
 
 
 class TestValidateUsername(unittest.TestCase):
@@ -402,21 +587,30 @@ class TestValidateUsername(unittest.TestCase):
 
 class TestValidateExpenseCost(unittest.TestCase):
     def test_cost_known_values(self):
-        values = ('10', '10.22', '108', '186.34', '71.33', '0.24', '0.25')
+        values = ('10', '10.22', '108', '186.34', '71.33', '0.24', '0.25',
+                  '.5', '3.', ' 7 ', 10, 0.5)
         for cost in values:
             fs.validate_expense_cost(cost)
 
     def test_cost_is_negative_or_zero(self):
-        values = ('0', '0.0', '-10', '-2.0')
+        values = ('0', '0.0', '-10', '-2.0', '0.004', 0.001)
         for cost in values:
             self.assertRaises(fs.IllegalExpenseCostError,
                               fs.validate_expense_cost, cost)
 
     def test_cost_is_not_a_number(self):
-        values = ('', ' ', 'a', 'a-10', '2.0b', 'sin(x)', '2*2')
+        values = ('', ' ', 'a', 'a-10', '2.0b', 'sin(x)', '2*2', 'inf', 'nan',
+                  '1e3', float('inf'), float('nan'), None)
+        for cost in values:
+            self.assertRaises(fs.IllegalExpenseCostError,
+                              fs.validate_expense_cost, cost)
+
+    def test_cost_is_too_large(self):
+        values = ('100000000000.01', '99999999999999999999', 1e17)
         for cost in values:
             self.assertRaises(fs.IllegalExpenseCostError,
                               fs.validate_expense_cost, cost)
+        fs.validate_expense_cost('100000000000')
 
 
 class TestValidateExpenseDate(unittest.TestCase):
@@ -432,7 +626,8 @@ class TestValidateExpenseDate(unittest.TestCase):
                               fs.validate_expense_date, date)
 
     def test_date_is_not_a_valid_date(self):
-        values = ('20130229', '20130431', '20130230', '', ' ', 'jkl', '0101')
+        values = ('20130229', '20130431', '20130230', '', ' ', 'jkl', '0101',
+                  '20131301', '00000101', '２０１３０１０１', 20130101, None)
         for date in values:
             self.assertRaises(fs.IllegalExpenseDateError, 
                               fs.validate_expense_date, date)